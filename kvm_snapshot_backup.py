@@ -2,34 +2,72 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import concurrent.futures
+import errno
 import fcntl
-import glob
+import heapq
+import json
 import shutil
+import struct
 from datetime import datetime
 import libvirt
 import logging
 import os
+import pathlib
 import re
-import shlex
 import subprocess
 import sys
+import threading
 from xml.etree import ElementTree
 from collections import namedtuple
 
+# domain disk info, see Domain.get_disks()
+DiskInfo = namedtuple('DiskInfo', ['device', 'file', 'format'])
+
+# <disk type='file' device='disk'> entries in domain XML
+_DISK_XPATH = "./devices/disk[@device='disk']"
+
+# ioctl request number to clone file extents on CoW filesystems (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+# qcow2 image header magic
+QCOW2_MAGIC = b'QFI\xfb'
+
+# seconds to wait for block job event before checking that the job still runs
+BLOCK_JOB_EVENT_TIMEOUT = 30
+
+# buffer size used for userspace file copies (e.g. cross-device backup directory, NFS)
+COPY_BUFSIZE = 4 << 20
+
 
 class Domain(object):
-    def __init__(self, libvirt_domain: libvirt.virDomain):
+    def __init__(self, libvirt_domain: libvirt.virDomain = None, name: str = None):
+        """ Domain is either libvirt domain or just its name (for actions working with backup files only) """
         self.libvirt_domain = libvirt_domain
-        self.name = libvirt_domain.name()
+        self.name = libvirt_domain.name() if libvirt_domain is not None else name
         self.libvirt_snapshot = None
+        # domain XML and disks cache, invalidated after domain disks changes
+        self._xml_cache = None
+        self._disks_cache = None
+        # guards backing files shared by disks backed up in parallel
+        self._copy_lock = threading.Lock()
+
+    def _get_xml(self):
+        """ Gets domain XML description (cached) """
+        if self._xml_cache is None:
+            self._xml_cache = self.libvirt_domain.XMLDesc()
+        return self._xml_cache
 
     def get_disks(self):
         """ Gets all domain disk as namedtuple('DiskInfo', ['device', 'file', 'format']) """
+        if self._disks_cache is not None:
+            return self._disks_cache
+
         # root node
-        root = ElementTree.fromstring(self.libvirt_domain.XMLDesc())
+        root = ElementTree.fromstring(self._get_xml())
 
         # search <disk type='file' device='disk'> entries
-        disks = root.findall("./devices/disk[@device='disk']")
+        disks = root.findall(_DISK_XPATH)
 
         # for every disk get drivers, sources and targets
         drivers = [disk.find("driver").attrib for disk in disks]
@@ -41,49 +79,36 @@ class Domain(object):
             raise RuntimeError("Drivers, sources and targets lengths are different %s:%s:%s" % (
                 len(drivers), len(sources), len(targets)))
 
-        disk_info = namedtuple('DiskInfo', ['device', 'file', 'format'])
-
         # all disks info
         disks_info = []
 
         for i in range(len(sources)):
-            disks_info.append(disk_info(targets[i]["dev"], sources[i]["file"], drivers[i]["type"]))
+            disks_info.append(DiskInfo(targets[i]["dev"], sources[i]["file"], drivers[i]["type"]))
 
+        self._disks_cache = disks_info
         return disks_info
 
     def create_snapshot_xml(self):
         """ Creates snapshot XML """
         snapshot_name = datetime.now().strftime("%Y%m%d_%H%M%S")
 
-        disk_specs = []
         domain_disks = self.get_disks()
 
-        for disk in domain_disks:
-            disk_basedir = os.path.dirname(disk.file)
-            disk_specs += ["--diskspec %s,file=\"%s/%s_%s-%s.%s\"" % (
-                disk.device, disk_basedir, self.name, disk.device, snapshot_name, disk.format)]
-
-        if not disk_specs:
+        if not domain_disks:
             raise RuntimeError("Wrong disk devices specified? Available devices: %s" % domain_disks)
 
-        snapshot_create_cmd = (
-            "virsh snapshot-create-as --domain {domain_name} {snapshot_name} {disk_specs}"
-            " --disk-only --atomic --quiesce --print-xml").format(
-            domain_name=self.name, snapshot_name=snapshot_name, disk_specs=" ".join(disk_specs))
-        logging.debug("Executing: '%s'" % snapshot_create_cmd)
-
-        snapshot_create_cmds = shlex.split(snapshot_create_cmd)
-
-        create_xml = subprocess.Popen(snapshot_create_cmds, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=False)
-
-        snapshot_xml = create_xml.stdout.read()
-
-        status = create_xml.wait()
+        # <domainsnapshot> with external snapshot file for every disk device
+        root = ElementTree.Element("domainsnapshot")
+        ElementTree.SubElement(root, "name").text = snapshot_name
+        disks = ElementTree.SubElement(root, "disks")
+        for disk in domain_disks:
+            disk_basedir = os.path.dirname(disk.file)
+            disk_spec = ElementTree.SubElement(disks, "disk", name=disk.device, snapshot="external")
+            ElementTree.SubElement(disk_spec, "source", file="%s/%s_%s-%s.%s" % (
+                disk_basedir, self.name, disk.device, snapshot_name, disk.format))
 
-        if status != 0:
-            logging.error("Error for '%s': %s" % (snapshot_create_cmd, create_xml.stderr.read()))
-            logging.critical("{exe} returned {status} state".format(exe=snapshot_create_cmds[0], status=status))
-            raise Exception("snapshot-create-as didn't work properly")
+        snapshot_xml = ElementTree.tostring(root)
+        logging.debug("Snapshot XML: %s" % snapshot_xml)
 
         return snapshot_xml
 
@@ -100,6 +125,8 @@ class Domain(object):
                  libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_ATOMIC,
                  # libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_QUIESCE,
                  libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_NO_METADATA]))
+        # domain disks point to new snapshot files now
+        self._xml_cache = self._disks_cache = None
         return self.libvirt_snapshot
 
     def backup_incremental(self, backup_dir: str):
@@ -117,34 +144,46 @@ class Domain(object):
             logging.info("Creating directory '%s'" % backup_domain_dir)
             os.mkdir(backup_domain_dir)
 
-        # for every disk
-        for disk in self.get_disks():
-            # get current backing file from disk_info
-            backing_file = DiskImageHelper.get_backing_file(disk.file)
-            # while it is a backing file for every snapshot disk
-            while backing_file is not None:
-                # backup file
-                backup_file = os.path.join(backup_domain_dir, os.path.basename(backing_file))
-                # do backup if not exists
-                backing_file_copy_result = False
-                if os.path.isfile(backup_file) is False:
-                    # copy
-                    logging.info("Copying '%s' to '%s'" % (backing_file, backup_file))
-                    shutil.copy2(backing_file, backup_file)
-                    backing_file_copy_result = True
-
-                # set parent backing file
-                backing_file = DiskImageHelper.get_backing_file(backing_file)
-                # set valid backing file for backup_file after copy
-                if backing_file_copy_result and backing_file:
-                    DiskImageHelper.set_backing_file(os.path.basename(backing_file), backup_file)
+        # backup every disk in parallel, disks are usually on independent devices
+        disks = self.get_disks()
+        # backup files already claimed by a disk worker, see _backup_one_disk()
+        claimed_backup_files = set()
+        max_workers = max(1, min(len(disks), os.cpu_count() or 1))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(self._backup_one_disk, disk, backup_domain_dir, claimed_backup_files)
+                       for disk in disks]
+            done, not_done = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_EXCEPTION)
+            for future in not_done:
+                future.cancel()
+            # propagate disk backup errors
+            for future in done:
+                future.result()
 
         # backup domain XML
         backup_xml_file = "%s/%s.xml" % (backup_domain_dir, self.name)
         logging.info("Creating domain XML backup '%s" % backup_xml_file)
-        backup_xml_fo = open(backup_xml_file, 'w')
-        backup_xml_fo.write(self.libvirt_domain.XMLDesc())
-        backup_xml_fo.close()
+        pathlib.Path(backup_xml_file).write_text(self._get_xml())
+
+    def _backup_one_disk(self, disk, backup_domain_dir: str, claimed_backup_files: set):
+        """ Backups all backing files of domain disk to 'backup_domain_dir' """
+        # get backing files tree of current disk, parent backing file follows its child
+        backing_files = DiskImageHelper.get_backing_chain(disk.file)
+        for backing_file, parent_backing_file in zip(backing_files, backing_files[1:] + [None]):
+            # backup file
+            backup_file = os.path.join(backup_domain_dir, os.path.basename(backing_file))
+            # disks sharing a backing file (e.g. common base image) must not copy it concurrently
+            with self._copy_lock:
+                if backup_file in claimed_backup_files:
+                    continue
+                claimed_backup_files.add(backup_file)
+            # do backup if not exists
+            if os.path.isfile(backup_file) is False:
+                # copy
+                logging.info("Copying '%s' to '%s'" % (backing_file, backup_file))
+                DiskImageHelper._reflink_or_copy(backing_file, backup_file)
+                # set valid backing file for backup_file after copy
+                if parent_backing_file:
+                    DiskImageHelper.set_backing_file(os.path.basename(parent_backing_file), backup_file)
 
     def get_backup_domain_dir(self, backup_dir):
         """ Gets full backup domain dir """
@@ -158,25 +197,27 @@ class Domain(object):
         disk_files_tree = []
         for disk in disks:
             disk_files_tree += (DiskImageHelper.get_backing_files_tree(disk.file))
-            merge_snapshot_cmd = "virsh blockpull --domain {domain_name} {disk_path} --wait".format(
-                domain_name=self.name, disk_path=disk.file)
-
-            logging.debug("Executing: '%s'" % merge_snapshot_cmd)
             logging.info("Merging base to new snapshot for '%s' device" % disk.device)
 
-            # launch command
-            merge_snapshot_cmds = shlex.split(merge_snapshot_cmd)
-            merge_snapshot = subprocess.Popen(merge_snapshot_cmds, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                              shell=False)
+            try:
+                job_status = self._block_pull(disk)
+            except libvirt.libvirtError as e:
+                logging.critical("Block pull of '%s' failed: %s" % (disk.file, e))
+                raise Exception("blockpull didn't work properly") from e
 
-            # wait to terminate
-            status = merge_snapshot.wait()
+            if job_status != libvirt.VIR_DOMAIN_BLOCK_JOB_COMPLETED:
+                logging.critical("Block pull of '%s' finished with %s status" % (disk.file, job_status))
+                raise Exception("blockpull didn't work properly")
 
-            if status != 0:
-                logging.error("Error for '%s': %s" % (merge_snapshot_cmd, merge_snapshot.stderr.read()))
-                logging.critical("{exe} returned {status} state".format(exe=merge_snapshot_cmds[0], status=status))
+            # old disk files are removed only if disk really has no backing files now
+            remaining_backing_files = DiskImageHelper.get_backing_chain(disk.file)
+            if remaining_backing_files:
+                logging.critical("Block pull of '%s' didn't complete, backing files left: %s" % (
+                    disk.file, remaining_backing_files))
                 raise Exception("blockpull didn't work properly")
 
+        # domain disks have no backing files now
+        self._xml_cache = self._disks_cache = None
         current_disk_files = [disk.file for disk in self.get_disks()]
 
         # remove old disk device files without current ones
@@ -184,89 +225,253 @@ class Domain(object):
             logging.info("Removing old disk file: '%s'" % file)
             os.remove(file)
 
+    def _block_pull(self, disk):
+        """ Pulls backing files data into disk image, waits for block job end and returns its status """
+        job_finished = threading.Event()
+        job_status = []
+
+        def block_job_callback(conn, dom, disk_target, job_type, status, opaque):
+            # pull job has no ready phase, every other status ends it
+            if disk_target == disk.device and status != libvirt.VIR_DOMAIN_BLOCK_JOB_READY:
+                job_status.append(status)
+                job_finished.set()
+
+        # block job events are dispatched by libvirt event loop, see run_libvirt_event_loop()
+        conn = self.libvirt_domain.connect()
+        callback_id = conn.domainEventRegisterAny(
+            self.libvirt_domain, libvirt.VIR_DOMAIN_EVENT_ID_BLOCK_JOB_2, block_job_callback, None)
+        try:
+            self.libvirt_domain.blockPull(disk.file, 0, 0)
+            # event can be lost (closed connection, no event loop), check that job still runs meanwhile
+            while not job_finished.wait(BLOCK_JOB_EVENT_TIMEOUT):
+                if not self.libvirt_domain.blockJobInfo(disk.file, 0) and not job_finished.is_set():
+                    raise Exception("Block job of '%s' ended without event" % disk.file)
+        finally:
+            conn.domainEventDeregisterAny(callback_id)
+        return job_status[0]
+
     def backup_rotate_daily(self, backup_dir: str, rotate: int):
         """ Rotates domain backup disk files in 'backup_dir' leaving the last 'rotate' backups """
         if rotate < 1:
             raise Exception("Rotate should be more than 0")
         backup_domain_dir = self.get_backup_domain_dir(backup_dir)
-        # for every file in directory group backups
-        for disk in self.get_disks():
+        if not os.path.isdir(backup_domain_dir):
+            logging.info("Backup directory '%s' doesn't exist, nothing to rotate" % backup_domain_dir)
+            return
+        # '{name}_{device}-{snapshot name}.{format}' backup disk files
+        backup_file_re = re.compile(r'^%s_(?P<dev>[^-]+)-(?P<ts>\d+_\d+)\.(?P<fmt>\w+)$' % re.escape(self.name))
+        # stat every backup file in directory once and group them by disk device (and format)
+        device_files = {}
+        with os.scandir(backup_domain_dir) as dir_entries:
+            for entry in dir_entries:
+                match = backup_file_re.match(entry.name)
+                if match and entry.is_file():
+                    device_files.setdefault((match.group('dev'), match.group('fmt')), []).append(
+                        (-entry.stat().st_mtime, entry.path))
+        # for every disk device group backups
+        for backup_files in device_files.values():
             grouped_files = []
-            backup_files = glob.glob(
-                os.path.join(backup_domain_dir, "%s_%s-*.%s" % (self.name, disk.device, disk.format)))
-            backup_files.sort(key=os.path.getmtime, reverse=True)
+            # newest first heap, only files of the kept groups are popped, the rest is removed
+            heapq.heapify(backup_files)
             backing_file = None
-            for backup_file in backup_files:
+            while backup_files and (len(grouped_files) < rotate or backing_file is not None):
+                _, backup_file = heapq.heappop(backup_files)
                 if backing_file is None:
                     grouped_files.append([])
                 grouped_files[-1].append(backup_file)
                 backing_file = DiskImageHelper.get_backing_file(backup_file)
             logging.debug("Grouped backup files %s" % grouped_files)
-            grouped_files_to_remove = grouped_files[rotate:]
-            logging.debug("Groups to remove %s" % grouped_files_to_remove)
-            for group in grouped_files_to_remove:
-                for file in group:
-                    logging.info("Removing old backup disk file: '%s'" % file)
-                    os.remove(file)
+            files_to_remove = [path for _, path in backup_files]
+            logging.debug("Files to remove %s" % files_to_remove)
+            for file in files_to_remove:
+                logging.info("Removing old backup disk file: '%s'" % file)
+                os.remove(file)
 
 
 class DiskImageHelper(object):
+    @staticmethod
+    def _reflink(src_fd: int, dst_fd: int):
+        """ Clones file extents (reflink), returns False if filesystem doesn't support it """
+        try:
+            fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        except OSError as e:
+            # cross-device copy or filesystem without reflink support
+            if e.errno not in (errno.EXDEV, errno.EOPNOTSUPP, errno.EINVAL, errno.ENOTTY):
+                raise
+            logging.debug("Reflink not possible: %s" % e.strerror)
+            return False
+        return True
+
+    @staticmethod
+    def _copy_file_range(src_fd: int, dst_fd: int):
+        """ Copies file in kernel with copy_file_range, returns False if it is not available """
+        if not hasattr(os, 'copy_file_range'):
+            return False
+        size = os.fstat(src_fd).st_size
+        offset = 0
+        while offset < size:
+            try:
+                copied = os.copy_file_range(src_fd, dst_fd, size - offset)
+            except OSError as e:
+                # fall back only when nothing was copied yet
+                if offset or e.errno not in (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+                logging.debug("copy_file_range not possible: %s" % e.strerror)
+                return False
+            if copied == 0:
+                # some filesystems copy nothing instead of failing, another copy method is used then
+                if offset == 0:
+                    logging.debug("copy_file_range copied nothing")
+                    return False
+                raise IOError("copy_file_range stopped after %s of %s bytes" % (offset, size))
+            offset += copied
+        return True
+
+    @staticmethod
+    def _sendfile(src_fd: int, dst_fd: int):
+        """ Copies file in kernel with sendfile, returns False if it is not available """
+        if not sys.platform.startswith('linux') or not hasattr(os, 'sendfile'):
+            return False
+        size = os.fstat(src_fd).st_size
+        offset = 0
+        while offset < size:
+            try:
+                sent = os.sendfile(dst_fd, src_fd, offset, min(size - offset, 1 << 30))
+            except OSError as e:
+                # fall back only when nothing was copied yet
+                if offset or e.errno not in (errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+                logging.debug("sendfile not possible: %s" % e.strerror)
+                return False
+            if sent == 0:
+                # nothing sent by first call, another copy method is used then
+                if offset == 0:
+                    logging.debug("sendfile copied nothing")
+                    return False
+                raise IOError("sendfile stopped after %s of %s bytes" % (offset, size))
+            offset += sent
+        return True
+
+    @staticmethod
+    def _fadvise(src_fd: int, dst_fd: int, advice: str):
+        """ Gives access pattern advice for whole source and destination files if platform supports it """
+        if not hasattr(os, 'posix_fadvise') or not hasattr(os, advice):
+            return
+        for fd in (src_fd, dst_fd):
+            os.posix_fadvise(fd, 0, 0, getattr(os, advice))
+
+    @staticmethod
+    def _reflink_or_copy(src: str, dst: str):
+        """ Copies file cloning its extents (reflink) when filesystem supports it, otherwise does a full copy """
+        # copy to temporary file, interrupted copy is never taken for finished backup
+        dst_part = "%s.part" % dst
+        try:
+            with open(src, 'rb') as src_fo, open(dst_part, 'wb') as dst_fo:
+                src_fd, dst_fd = src_fo.fileno(), dst_fo.fileno()
+                if not DiskImageHelper._reflink(src_fd, dst_fd):
+                    # single pass sequential copy, don't keep copied data in page cache
+                    DiskImageHelper._fadvise(src_fd, dst_fd, 'POSIX_FADV_SEQUENTIAL')
+                    if not DiskImageHelper._copy_file_range(src_fd, dst_fd) and \
+                            not DiskImageHelper._sendfile(src_fd, dst_fd):
+                        shutil.copyfileobj(src_fo, dst_fo, COPY_BUFSIZE)
+                        dst_fo.flush()
+                    # dirty pages have to be written before they can be dropped
+                    os.fdatasync(dst_fd)
+                    DiskImageHelper._fadvise(src_fd, dst_fd, 'POSIX_FADV_DONTNEED')
+            shutil.copystat(src, dst_part)
+            os.replace(dst_part, dst)
+        except BaseException:
+            if os.path.exists(dst_part):
+                os.remove(dst_part)
+            raise
+
+    @staticmethod
+    def _read_qcow2_backing(path: str):
+        """ Reads backing file name directly from qcow2 image header """
+        with open(path, 'rb') as image_fo:
+            header = image_fo.read(4096)
+            if len(header) < 20 or header[:4] != QCOW2_MAGIC:
+                raise ValueError("'%s' is not a qcow2 image" % path)
+            # backing_file_offset (8 bytes) and backing_file_size (4 bytes) follow magic and version
+            backing_file_offset, backing_file_size = struct.unpack('>QI', header[8:20])
+            if backing_file_offset == 0:
+                return None
+            image_fo.seek(backing_file_offset)
+            return image_fo.read(backing_file_size).decode('utf-8')
+
     @staticmethod
     def get_backing_file(file: str):
         """ Gets backing file for disk image """
-        get_backing_file_cmd = "qemu-img info %s" % file
-        logging.debug("Executing: '%s'" % get_backing_file_cmd)
-        out = subprocess.check_output(shlex.split(get_backing_file_cmd))
-        lines = out.decode('utf-8').split('\n')
-        for line in lines:
-            if re.search("backing file:", line):
-                return line.strip().split()[2]
-        return None
+        try:
+            return DiskImageHelper._read_qcow2_backing(file)
+        except ValueError:
+            # other image formats (raw, vmdk, ...) are read by qemu-img
+            pass
+
+        get_backing_file_cmds = ["qemu-img", "info", "--output=json", file]
+        logging.debug("Executing: '%s'" % " ".join(get_backing_file_cmds))
+        out = subprocess.check_output(get_backing_file_cmds)
+        info = json.loads(out.decode('utf-8'))
+        return info.get('backing-filename')
+
+    @staticmethod
+    def get_backing_chain(file: str):
+        """ Gets all backing files (snapshot tree) for disk image with one qemu-img call """
+        get_backing_chain_cmds = ["qemu-img", "info", "--backing-chain", "--output=json", file]
+        logging.debug("Executing: '%s'" % " ".join(get_backing_chain_cmds))
+        out = subprocess.check_output(get_backing_chain_cmds)
+        # first entry is the image itself
+        chain = json.loads(out.decode('utf-8'))
+        return [entry['filename'] for entry in chain[1:]]
 
     @staticmethod
     def get_backing_files_tree(file: str):
         """ Gets all backing files (snapshot tree) for disk image """
-        backing_files = []
-        backing_file = DiskImageHelper.get_backing_file(file)
-        while backing_file is not None:
-            backing_files.append(backing_file)
-            backing_file = DiskImageHelper.get_backing_file(backing_file)
-        return backing_files
+        return DiskImageHelper.get_backing_chain(file)
 
     @staticmethod
     def set_backing_file(backing_file: str, file: str):
         """ Sets backing file for disk image """
-        set_backing_file_cmd = "qemu-img rebase -u -b %s %s" % (backing_file, file)
-        logging.debug("Executing: '%s'" % set_backing_file_cmd)
-        subprocess.check_output(shlex.split(set_backing_file_cmd))
+        set_backing_file_cmds = ["qemu-img", "rebase", "-u", "-b", backing_file, file]
+        logging.debug("Executing: '%s'" % " ".join(set_backing_file_cmds))
+        subprocess.check_output(set_backing_file_cmds)
 
 
 script_name = os.path.basename(sys.argv[0][:-3])
 
-if __name__ == "__main__":
+
+def run_libvirt_event_loop():
+    """ Runs libvirt default event loop (needed by connection keepalive and block job events) """
+    while True:
+        libvirt.virEventRunDefaultImpl()
+
+
+def main(argv):
     parser = argparse.ArgumentParser()
     subparsers = parser.add_subparsers()
     backup_parser = subparsers.add_parser('backup')
     backup_parser.add_argument('-a', '--action', action="store_const", const="backup", default="backup")
-    backup_parser.add_argument('-d', '--domain', required=True)
+    backup_parser.add_argument('-d', '--domain', nargs='+', required=True)
     backup_parser.add_argument('-b', '--backup-dir', dest='backup_dir', required=True)
     merge_parser = subparsers.add_parser('merge')
     merge_parser.add_argument('-a', '--action', action="store_const", const="merge", default="merge")
-    merge_parser.add_argument('-d', '--domain', required=True)
+    merge_parser.add_argument('-d', '--domain', nargs='+', required=True)
     rotate_parser = subparsers.add_parser('rotate')
     rotate_parser.add_argument('-a', '--action', action="store_const", const="backup", default="rotate")
     rotate_parser.add_argument('-r', '--rotate', default=1, type=int)
-    rotate_parser.add_argument('-d', '--domain', required=True)
+    rotate_parser.add_argument('-d', '--domain', nargs='+', required=True)
     rotate_parser.add_argument('-b', '--backup-dir', dest='backup_dir', required=True)
     parser.add_argument('-v', dest='verbose', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
                         type=str)
 
-    command_args = parser.parse_args()
+    command_args = parser.parse_args(argv)
 
     if not any(vars(command_args).values()) or vars(command_args) == {"verbose": "INFO"}:
         parser.print_usage()
         exit()
 
+    failed_domains = []
+
     try:
         pid_file = '/tmp/kvm_snapshot_backup.lock'
         fp = open(pid_file, 'w')
@@ -278,23 +483,50 @@ if __name__ == "__main__":
 
         logging.debug("START")
 
+        # event loop has to be registered before connection is opened
+        libvirt.virEventRegisterDefaultImpl()
+        threading.Thread(target=run_libvirt_event_loop, name="libvirt-event-loop", daemon=True).start()
+
         logging.debug("Opening libvirt connection to qemu")
         app_libvirt_conn = libvirt.open("qemu:///system")
 
-        app_domain = Domain(app_libvirt_conn.lookupByName(command_args.domain))
-
-        if command_args.action == "backup":
-            app_domain.backup_incremental(command_args.backup_dir)
-        elif command_args.action == "merge":
-            app_domain.merge_snapshot()
-        elif command_args.action == "rotate":
-            app_domain.backup_rotate_daily(command_args.backup_dir, command_args.rotate)
-
-        app_libvirt_conn.close()
+        try:
+            # one connection is shared by all domains, keep it alive during long running actions
+            app_libvirt_conn.setKeepAlive(5, 3)
+
+            for domain_name in command_args.domain:
+                # failed domain doesn't stop the others
+                try:
+                    if command_args.action == "rotate":
+                        # rotate works with backup files only, domain doesn't have to exist anymore
+                        app_domain = Domain(name=domain_name)
+                    else:
+                        app_domain = Domain(app_libvirt_conn.lookupByName(domain_name))
+
+                    if command_args.action == "backup":
+                        app_domain.backup_incremental(command_args.backup_dir)
+                    elif command_args.action == "merge":
+                        app_domain.merge_snapshot()
+                    elif command_args.action == "rotate":
+                        app_domain.backup_rotate_daily(command_args.backup_dir, command_args.rotate)
+                except Exception as e:
+                    logging.error("Domain '%s' failed: %s" % (domain_name, e))
+                    failed_domains.append(domain_name)
+        finally:
+            app_libvirt_conn.close()
 
     except IOError as ioe:
         logging.error(str(ioe))
-    except RuntimeError as re:
-        logging.error(str(re))
+    except RuntimeError as rte:
+        logging.error(str(rte))
+
+    if failed_domains:
+        logging.error("Failed domains: %s" % ", ".join(failed_domains))
 
     logging.debug("STOP")
+
+    return 1 if failed_domains else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))